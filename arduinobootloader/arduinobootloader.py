@@ -7,12 +7,12 @@ The module implements the essential parts that Avrdude uses for the
 arduino and wiring protocols. In turn, they are a subset of the
 STK500 V1 and V2 protocols respectively.
 '''
-from os import environ
+import os
 
 # From Kivy source code: On Android sys.platform returns 'linux2',
 # so prefer to check the presence of python-for-android environment
 # variables (ANDROID_ARGUMENT or ANDROID_PRIVATE).
-OS_ANDROID = True if 'ANDROID_ARGUMENT' in environ else False
+OS_ANDROID = True if 'ANDROID_ARGUMENT' in os.environ else False
 
 if OS_ANDROID:
     from usb4a import usb
@@ -21,36 +21,70 @@ else:
     import serial
     import serial.tools.list_ports
 
+import collections
+import functools
+import operator
+import struct
 import time
 
 
+SERIAL_TIMEOUT = 0.1
+"""Read timeout of the serial port in seconds, the wait of the long answers is extended by their transfer time"""
+
 RESP_STK_OK = 0x10
 """End message of the Stk500v1"""
 
 RESP_STK_IN_SYNC = 0x14
 """Start message of the Stk500v1"""
 
-AVR_ATMEL_CPUS = {0x1E9608: ["ATmega640", (128*2), 1024],
-                  0x1E9802: ["ATmega2561", (128*2), 1024],
-                  0x1E9801: ["ATmega2560", (128*2), 1024],
-                  0x1E9703: ["ATmega1280", (128*2), 512],
-                  0x1E9705: ["ATmega1284P", (128*2), 512],
-                  0x1E9704: ["ATmega1281", (128*2), 512],
-                  0x1E9782: ["AT90USB1287", (128 * 2), 512],
-                  0x1E9702: ["ATmega128", (128*2), 512],
-                  0x1E9602: ["ATmega64", (128*2), 256],
-                  0x1E9502: ["ATmega32", (64*2), 256],
-                  0x1E9403: ["ATmega16", (64*2), 128],
-                  0x1E9307: ["ATmega8", (32 * 2), 128],
-                  0x1E930A: ["ATmega88", (32*2), 128],
-                  0x1E9406: ["ATmega168", (64*2), 256],
-                  0x1E950F: ["ATmega328P", (64*2), 256],
-                  0x1E9514: ["ATmega328", (64*2), 256],
-                  0x1E9404: ["ATmega162", (64*2), 128],
-                  0x1E9402: ["ATmega163", (64*2), 128],
-                  0x1E9405: ["ATmega169", (64*2), 128],
-                  0x1E9306: ["ATmega8515", (32*2), 128],
-                  0x1E9308: ["ATmega8535", (32*2), 128]}
+STK_LOAD_ADDRESS = 0x55
+"""Set the address of the Stk500v1 Protocol ('U')"""
+
+STK_PROG_PAGE = 0x64
+"""Write a page of the Stk500v1 Protocol ('d')"""
+
+STK_READ_PAGE = 0x74
+"""Read a page of the Stk500v1 Protocol ('t')"""
+
+STK_MEMTYPE_FLASH = 0x46
+"""Flash memory type of the page commands ('F')"""
+
+STK_MEMTYPE_EEPROM = 0x45
+"""Eeprom memory type of the page commands ('E')"""
+
+CRC_EOP = 0x20
+"""End of command of the Stk500v1 Protocol (' ')"""
+
+STK_UNIVERSAL = 0x56
+"""Send an instruction of the ISP interface of the Stk500v1 Protocol ('V')"""
+
+AVR_OP_CHIP_ERASE = b'\xAC\x80\x00\x00'
+"""Chip erase instruction of the ISP interface of the AVR CPUs"""
+
+CpuInfo = collections.namedtuple("CpuInfo", "name page_size pages")
+"""Name, flash page size in bytes and count of flash pages of a CPU"""
+
+AVR_ATMEL_CPUS = {0x1E9608: CpuInfo("ATmega640", (128*2), 1024),
+                  0x1E9802: CpuInfo("ATmega2561", (128*2), 1024),
+                  0x1E9801: CpuInfo("ATmega2560", (128*2), 1024),
+                  0x1E9703: CpuInfo("ATmega1280", (128*2), 512),
+                  0x1E9705: CpuInfo("ATmega1284P", (128*2), 512),
+                  0x1E9704: CpuInfo("ATmega1281", (128*2), 512),
+                  0x1E9782: CpuInfo("AT90USB1287", (128*2), 512),
+                  0x1E9702: CpuInfo("ATmega128", (128*2), 512),
+                  0x1E9602: CpuInfo("ATmega64", (128*2), 256),
+                  0x1E9502: CpuInfo("ATmega32", (64*2), 256),
+                  0x1E9403: CpuInfo("ATmega16", (64*2), 128),
+                  0x1E9307: CpuInfo("ATmega8", (32*2), 128),
+                  0x1E930A: CpuInfo("ATmega88", (32*2), 128),
+                  0x1E9406: CpuInfo("ATmega168", (64*2), 256),
+                  0x1E950F: CpuInfo("ATmega328P", (64*2), 256),
+                  0x1E9514: CpuInfo("ATmega328", (64*2), 256),
+                  0x1E9404: CpuInfo("ATmega162", (64*2), 128),
+                  0x1E9402: CpuInfo("ATmega163", (64*2), 128),
+                  0x1E9405: CpuInfo("ATmega169", (64*2), 128),
+                  0x1E9306: CpuInfo("ATmega8515", (32*2), 128),
+                  0x1E9308: CpuInfo("ATmega8535", (32*2), 128)}
 
 """ 
 Dictionary with the list of Atmel AVR 8 CPUs used by Arduino boards. 
@@ -58,6 +92,16 @@ Contains the size in bytes and the number of pages in flash memory.
 The key is the processor signature which is made up of SIG1, SIG2 and SIG3.
 """
 
+ATMEL_SIG1 = 0x1E
+"""First byte of the signature, it identifies Atmel as the manufacturer"""
+
+VERIFY_WINDOW = 2
+"""Count of transfers written that wait to be read back and compared, when the verify is interleaved with the write"""
+
+_CPU_BY_SIG = {signature & 0xFFFF: cpu for signature, cpu in AVR_ATMEL_CPUS.items()
+               if (signature >> 16) == ATMEL_SIG1}
+"""The same list of CPUs, indexed by SIG2 and SIG3 as a 16 bits integer."""
+
 MESSAGE_START = 0x1B
 """Start message of the Stk500v2 header (ESC = 27 decimal)"""
 
@@ -88,6 +132,9 @@ CMD_READ_FLASH_ISP = 0x14
 CMD_LEAVE_PROGMODE_ISP = 0x11
 """Leave the programmer mode of the Stk500v2 Protocol"""
 
+CMD_CHIP_ERASE_ISP = 0x12
+"""Erase the flash of the Stk500v2 Protocol"""
+
 OPT_HW_VERSION = b'\x90'
 """Hardware version of the bootloader"""
 
@@ -106,6 +153,103 @@ CPU_SIG2 = 1
 CPU_SIG3 = 2
 """Cpu signature part 3"""
 
+_SET_ADDR = struct.Struct("<BHB")
+"""Stk500v1 set address command: command, address in little endian and end of command"""
+
+_PAGE_HDR = struct.Struct(">BHB")
+"""Stk500v1 header of the write and read page commands: command, length in big endian and memory type"""
+
+_V2_HDR = struct.Struct(">BBHB")
+"""Stk500v2 message header: start, sequence number, length in big endian and token"""
+
+
+def _xor_checksum(buff, checksum=0):
+    """Calculate the XOR of all the bytes of the buffer, that is the checksum of the Stk500v2.
+    The long buffers (like a flash page) are converted to a single integer that is folded
+    by halves, so each XOR is done by C code over many bytes at a time, and the count
+    of python operations is logarithmic with the buffer length.
+
+    :param buff: data of the checksum.
+    :type buff: bytearray
+    :param checksum: initial value of the checksum.
+    :type checksum: int
+    :return: the checksum (8 bits).
+    :rtype: int
+    """
+    if len(buff) < 64:
+        return functools.reduce(operator.xor, buff, checksum)
+
+    value = int.from_bytes(buff, "little")
+    """The width in bytes is rounded up to a power of two, the zeros don't change the XOR."""
+    width = 1 << (len(buff) - 1).bit_length()
+    while width > 1:
+        width >>= 1
+        value = (value >> (width * 8)) ^ (value & ((1 << (width * 8)) - 1))
+    return value ^ checksum
+
+
+class _Programmer(object):
+    """Methods shared by the programmers of both protocols, that split the transfers larger
+    than a page in page commands and send them in batches of up to pipeline_depth pages.
+    The subclasses give the attributes _ab and pipeline_depth, and the methods read_memory
+    and _read_batch.
+    """
+    def _split_pages(self, buffer, flash):
+        """Split a buffer larger than a page of flash in its pages.
+
+        :param buffer: data to write.
+        :type buffer: bytes, bytearray or memoryview
+        :type flash: bool
+        :return: the views of each page, or None when the buffer fits in a single command.
+        :rtype: list
+        """
+        page_size = self._ab._cpu_page_size
+        if flash and page_size and len(buffer) > page_size:
+            return [buffer[offset:offset + page_size] for offset in range(0, len(buffer), page_size)]
+        return None
+
+    def _read_pages(self, address, count, flash):
+        """Read the memory of several pages, one by one. With a pipeline_depth of more
+        than one, the commands of up to that count of pages are sent in a single write
+        by _read_batch. If there is an error, the pages of the batch are read one by one.
+
+        :param address: memory address of the first byte to read.
+        :type address: int
+        :param count: bytes to read.
+        :type count: int
+        :type flash: bool
+        :return: the buffer read or None when there is error.
+        :rtype: memoryview
+        """
+        page_size = self._ab._cpu_page_size
+        sizes = [min(page_size, count - offset) for offset in range(0, count, page_size)]
+        depth = self.pipeline_depth
+        data = []
+        for first in range(0, len(sizes), depth):
+            batch = sizes[first:first + depth]
+            if len(batch) > 1 and self._ab.device:
+                buffer = self._read_batch(address, batch, flash)
+                if buffer is not None:
+                    data.append(buffer)
+                    address += sum(batch)
+                    continue
+
+                self._discard_answers()
+
+            for size in batch:
+                buffer = self.read_memory(address, size, flash)
+                if buffer is None:
+                    return None
+                data.append(buffer)
+                address += size
+        return memoryview(b"".join(data))
+
+    def _discard_answers(self):
+        """Discard the answers in flight of a batch that failed, before the commands
+        are sent again one by one."""
+        self._ab.device.reset_input_buffer()
+
+
 class ArduinoBootloader(object):
     """Contains the two inner classes that support the Stk500 V1 and V2 protocols
     for comunicate with arduino bootloaders.
@@ -113,6 +257,7 @@ class ArduinoBootloader(object):
     def __init__(self, *args, **kwargs):
         self.device = None
         self.port = None
+        self._fd = None
         self._hw_version = 0
         self._sw_major = 0
         self._sw_minor = 0
@@ -158,6 +303,18 @@ class ArduinoBootloader(object):
         """
         return self._cpu_page_size
 
+    @property
+    def cpu_xfer_size(self):
+        """Bytes of each write / read transfer: the page size times the pipeline_depth of
+        the selected programmer, so each transfer fills a batch of pipelined commands.
+        The programmers split the larger transfers in page commands.
+
+        :setter: size
+        :type: int
+        """
+        depth = getattr(self._programmer, "pipeline_depth", 1)
+        return self._cpu_page_size * max(1, depth)
+
     @property
     def cpu_pages(self):
         """CPU flash pages
@@ -185,35 +342,34 @@ class ArduinoBootloader(object):
         :return: None for unknow protocol
         :rtype: object
         """
-        if protocol == "Stk500v1":
-            self._programmer = self.Stk500v1(self)
-        elif protocol == "Stk500v2":
-            self._programmer = self.Stk500v2(self)
-        else:
-            self._programmer = None
+        programmer = self._PROTOCOLS.get(protocol)
+        self._programmer = programmer(self) if programmer else None
 
         return self._programmer
 
     def _is_cpu_signature(self, signature):
         """Look for the CPU signature in the list of Arduino boards.
 
-        :param signature: Atmel cpu 24 bits identificator
-        :type signature: int
+        :param signature: Atmel cpu 24 bits identificator (SIG1, SIG2 and SIG3).
+        :type signature: bytes
         :return: True the signature is on the supported CPU list.
         :rtype: bool
         """
-        try:
-            list_cpu = AVR_ATMEL_CPUS[signature]
-            self._cpu_name = list_cpu[0]
-            self._cpu_page_size = list_cpu[1]
-            self._cpu_pages = list_cpu[2]
-            return True
-        except KeyError:
-            self._cpu_name = "signature: {:06x}".format(signature)
+        info = None
+        if signature[0] == ATMEL_SIG1:
+            info = _CPU_BY_SIG.get((signature[1] << 8) | signature[2])
+
+        if info is None:
+            self._cpu_name = "signature: {}".format(signature.hex())
             self._cpu_page_size = 0
             self._cpu_pages = 0
             return False
 
+        self._cpu_name = info.name
+        self._cpu_page_size = info.page_size
+        self._cpu_pages = info.pages
+        return True
+
     def _find_device_port(self):
         """Look in the list of serial ports, one that corresponds to CH340 or XXX
         that Arduino boards typically use.
@@ -236,6 +392,8 @@ class ArduinoBootloader(object):
         """ Find and open the communication port where the Arduino is connected.
         Generate the reset sequence with the DTR / RTS pins.
         Send the sync command to verify that there is a valid bootloader.
+        On desktop platforms the USB serial converter is set in low latency mode
+        to shorten the round trip of each command.
 
         :param port: serial port identifier (example: ttyUSB0 or COM1). None for automatic board search.
         :type port: str
@@ -255,15 +413,43 @@ class ArduinoBootloader(object):
                 if not usb.has_usb_permission(device):
                     usb.request_usb_permission(device)
                     return
-                self.device = serial4a.get_serial_port(port, speed, 8, 'N', 1, timeout=1)
+                self.device = serial4a.get_serial_port(port, speed, 8, 'N', 1, timeout=SERIAL_TIMEOUT)
 
                 if self.device:
                     self.device.USB_READ_TIMEOUT_MILLIS = 1000
             else:
-                self.device = serial.Serial(port, speed, 8, 'N', 1, timeout=1)
+                """The port is configured before opening it, with DTR and RTS released and
+                without hardware flow control, so the open does not reset the board, the
+                reset is done only once by the sequence below."""
+                device = serial.Serial()
+                device.port = port
+                device.baudrate = speed
+                device.timeout = SERIAL_TIMEOUT
+                device.write_timeout = 1
+                device.dsrdtr = False
+                device.dtr = False
+                device.rts = False
+                device.open()
+                self.device = device
 
         self.port = port
 
+        if not OS_ANDROID:
+            self._set_low_latency()
+
+            """On Windows enlarge the buffers of the driver, so it can transfer the answers of
+            the batched commands at once. The method only exists on Windows."""
+            try:
+                self.device.set_buffer_size(rx_size=1 << 16, tx_size=1 << 16)
+            except AttributeError:
+                pass
+
+            """On posix the port has a file descriptor, that allows writing without the python layer of pyserial."""
+            try:
+                self._fd = self.device.fileno()
+            except (AttributeError, OSError, ValueError):
+                self._fd = None
+
         ''' Clear DTR and RTS to unload the RESET capacitor of the Arduino boards'''
         self.device.dtr = True
         self.device.rts = True
@@ -271,19 +457,217 @@ class ArduinoBootloader(object):
         ''' Set DTR and RTS back to high '''
         self.device.dtr = False
         self.device.rts = False
-        time.sleep(1 / 20)
 
-        """Discards bytes generated by the initialization sequence."""
+        """Discards bytes generated by the initialization sequence.
+        There is no wait for the bootloader to start, the programmers poll it with the sync command."""
         self.device.reset_input_buffer()
         return True
 
+    def _set_low_latency(self):
+        """The latency timer of the USB serial converters (16 mS by default on FTDI)
+        dominates the round trip of the short command / response pairs of the bootloader.
+        Enable the low latency mode of the port, and on Linux set the latency timer to 1 mS.
+        Both settings are optional, the errors are ignored when the platform or the driver
+        does not support them.
+        """
+        try:
+            self.device.set_low_latency_mode(True)
+        except AttributeError:
+            self._set_async_low_latency()
+        except (NotImplementedError, ValueError, OSError):
+            pass
+
+        latency_timer = "/sys/bus/usb-serial/devices/{}/latency_timer".format(os.path.basename(self.port))
+        try:
+            with open(latency_timer, "w") as file:
+                file.write("1")
+        except OSError:
+            pass
+
+    def _set_async_low_latency(self):
+        """Versions of pyserial older than 3.5 don't implement the low latency mode,
+        so set the ASYNC_LOW_LATENCY flag directly with the ioctl of the Linux serial driver.
+        """
+        try:
+            import array
+            import fcntl
+
+            TIOCGSERIAL = 0x541E
+            TIOCSSERIAL = 0x541F
+            ASYNC_LOW_LATENCY = 1 << 13
+
+            """The flags are the fifth field of the serial_struct of the driver."""
+            serial_struct = array.array('i', [0] * 32)
+            fcntl.ioctl(self.device.fileno(), TIOCGSERIAL, serial_struct)
+            serial_struct[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(self.device.fileno(), TIOCSSERIAL, serial_struct)
+        except (ImportError, AttributeError, OSError, ValueError):
+            pass
+
+    def _write(self, buff):
+        """Write the buffer in the serial port. When the port has a file descriptor it
+        is written directly with os.write, and the bytes that it could not accept
+        are written with pyserial.
+
+        :param buff: bytes to send.
+        :type buff: bytearray
+        """
+        if self._fd is not None:
+            try:
+                written = os.write(self._fd, buff)
+            except OSError:
+                written = 0
+
+            if written == len(buff):
+                return
+            buff = buff[written:]
+
+        self.device.write(buff)
+
+    def _read_exact(self, size, sent=0):
+        """Read the requested count of bytes from the serial port.
+        The serial ports can return fewer bytes than requested before the timeout
+        (for example, the Android one), so the read is repeated until the deadline
+        given by the timeout of the port, extended by the time to transfer the
+        command just sent and its answer.
+
+        :param size: bytes to read.
+        :type size: int
+        :param sent: bytes of the command just sent, that can still be in transmission.
+        :type sent: int
+        :return: bytes read, less than size when the timeout expires.
+        :rtype: bytes
+        """
+        read = self.device.read
+        deadline = time.monotonic() + self.device.timeout + self._transfer_time(size + sent)
+        buff = read(size)
+        while len(buff) < size and time.monotonic() < deadline:
+            buff += read(size - len(buff))
+        return buff
+
+    def _transfer_time(self, count):
+        """Time to transfer bytes at the baudrate of the port, each byte has 10 bits
+        with the start and stop bits.
+
+        :param count: bytes to transfer.
+        :type count: int
+        :return: the time in seconds.
+        :rtype: float
+        """
+        return count * 10 / self.device.baudrate
+
+    def flash_image(self, ih, progress_cb=None, verify=True):
+        """Write the firmware to the flash with the selected programmer, that must be open
+        and with the cpu signature read. The progress is given by the generator returned.
+
+        :param ih: firmware to write.
+        :type ih: IntelHex
+        :param progress_cb: function called with the phase and the fraction of each step.
+        :type progress_cb: callable
+        :param verify: read back and compare each transfer written.
+        :type verify: bool
+        :return: generator of (phase, fraction) tuples, the phase is write or verify, and
+                 the last one is done or error.
+        :rtype: generator
+        """
+        return self.flash_binary(ih.tobinstr(start=0, end=ih.maxaddr()), ih.segments(), progress_cb, verify)
+
+    def flash_binary(self, data, segments, progress_cb=None, verify=True):
+        """Same as flash_image, for a firmware that is already an image from the address 0,
+        for example converted by a parser in another process.
+
+        Only the pages of the segments are written, the gaps between them are skipped. The
+        pages that the file defines are always written, even with all the bytes at 0xFF,
+        because the bootloaders don't erase the flash before. The consecutive pages are
+        grouped in transfers of up to cpu_xfer_size.
+        The verify is interleaved with the write: once more than a window of transfers are
+        written, the oldest are read back and compared, so there is a single pass over the image.
+
+        :param data: image of the firmware from the address 0.
+        :type data: bytes
+        :param segments: start and end address of each segment with data, as IntelHex.segments.
+        :type segments: list
+        :param progress_cb: function called with the phase and the fraction of each step.
+        :type progress_cb: callable
+        :param verify: read back and compare each transfer written.
+        :type verify: bool
+        :return: generator of (phase, fraction) tuples, the phase is write or verify, and
+                 the last one is done or error.
+        :rtype: generator
+        """
+        def step(phase, fraction):
+            if progress_cb:
+                progress_cb(phase, fraction)
+            return phase, fraction
+
+        prg = self._programmer
+        page_size = self._cpu_page_size
+        if prg is None or not page_size:
+            yield step("error", 0)
+            return
+
+        """The image is padded to whole pages with the value of the erased flash, in a single
+        copy that is skipped when the image is already bytes of whole pages. The transfers
+        written are views of it, and the programmers only copy them to their commands."""
+        padding = -len(data) % page_size
+        if padding or not isinstance(data, bytes):
+            data = b"".join((data, b'\xff' * padding))
+        image = memoryview(data)
+        size = len(data)
+
+        xfer_size = self.cpu_xfer_size
+        transfers = []
+        for start, end in segments:
+            for address in range(start - start % page_size, end, page_size):
+                if transfers and transfers[-1][1] > address:
+                    continue
+                if transfers and transfers[-1][1] == address and address - transfers[-1][0] < xfer_size:
+                    transfers[-1][1] = address + page_size
+                else:
+                    transfers.append([address, address + page_size])
+
+        def check(transfer):
+            """Read a transfer and compare it with the image at its offset. The startswith
+            of the bytes compares the buffer read in place with memcmp, without copying it
+            nor the slice of the image, while the compare of memoryviews is byte by byte."""
+            start, end = transfer
+            read_buffer = prg.read_memory(start, end - start)
+            return (read_buffer is not None and len(read_buffer) == end - start
+                    and data.startswith(read_buffer, start))
+
+        pending = collections.deque()
+        for transfer in transfers:
+            if not prg.write_memory(image[transfer[0]:transfer[1]], transfer[0]):
+                yield step("error", transfer[0] / size)
+                return
+            yield step("write", transfer[1] / size)
+
+            if verify:
+                pending.append(transfer)
+            while len(pending) > VERIFY_WINDOW:
+                transfer = pending.popleft()
+                if not check(transfer):
+                    yield step("error", transfer[0] / size)
+                    return
+                yield step("verify", transfer[1] / size)
+
+        """Verify the transfers of the last window."""
+        for transfer in pending:
+            if not check(transfer):
+                yield step("error", transfer[0] / size)
+                return
+            yield step("verify", transfer[1] / size)
+
+        yield step("done", 1)
+
     def close(self):
         """Close the serial communication port."""
+        self._fd = None
         if (not self.device is None) and self.device.is_open:
             self.device.close()
             self.device = None
 
-    class Stk500v1(object):
+    class Stk500v1(_Programmer):
         """It encapsulates the communication protocol that Arduino uses for the first
            versions of bootoloader, which can write up to 128 K bytes of flash memory.
            For example: Nano, Uno, etc.
@@ -292,15 +676,21 @@ class ArduinoBootloader(object):
         def __init__(self, ab):
             self._ab = ab
             self._answer = None
+            self._write_page = None
+            """Count of pages whose commands are sent without waiting for the answer of the
+            previous ones. Optiboot and ATmegaBOOT poll the UART and lose the commands received
+            while they write the flash or send a page, so by default each command waits for
+            its answer. Only a bootloader that buffers the UART can use more than one."""
+            self.pipeline_depth = 1
 
-        def open(self, port=None, speed=57600):
+        def open(self, port=None, speed=115200):
             """Find and open the communication port where the Arduino is connected.
             Generate the reset sequence with the DTR / RTS pins.
             Send the sync command to verify that there is a valid bootloader.
 
             :param port: serial port identifier (example: ttyUSB0 or COM1). None for automatic board search.
             :type port: str
-            :param speed: comunication baurate, for older bootloader use 57600.
+            :param speed: comunication baurate, 115200 for Optiboot, for older bootloader use 57600.
             :type speed: int
             :return: True when the serial port was opened and the connection to the board was established.
             :rtype: bool
@@ -316,16 +706,29 @@ class ArduinoBootloader(object):
 
         def get_sync(self):
             """Send the sync command whose function is to discard the reception buffers of both serial units.
-            Set the receive unit timeout to 500mS and send the sync command up to 5 times to eliminate noise from the line.
+            Poll the bootloader while it starts after the reset, sending the sync command every 20mS
+            for up to 2 seconds, so the connection is established as soon as the bootloader answers.
 
             :return: True when success.
             :rtype: bool
             """
-            self._ab.device.timeout = 1 / 2
-            for i in range(1, 5):
+            deadline = time.monotonic() + 2
+            self._ab.device.timeout = 1 / 50
+            tries = 0
+            while time.monotonic() < deadline:
+                tries += 1
                 if self._cmd_request(b"0 ", answer_len=2):
-                    self._ab.device.timeout = 1
-                    return True
+                    self._ab.device.timeout = SERIAL_TIMEOUT
+                    if tries == 1:
+                        return True
+
+                    """The answers of the previous tries can arrive late, wait for them,
+                    discard them and confirm the synchronization."""
+                    time.sleep(1 / 50)
+                    self._ab.device.reset_input_buffer()
+                    return self._cmd_request(b"0 ", answer_len=2)
+
+            self._ab.device.timeout = SERIAL_TIMEOUT
             return False
 
         def board_request(self):
@@ -342,7 +745,7 @@ class ArduinoBootloader(object):
             if not self._cmd_request(b"A\x81 ", answer_len=3):
                 return False
 
-            self._ab._hw_version = self._answer[1]
+            self._ab._sw_major = self._answer[1]
 
             if not self._cmd_request(b"A\x82 ", answer_len=3):
                 return False
@@ -356,10 +759,7 @@ class ArduinoBootloader(object):
                 return False
 
             """The name of the programmer is between the beginning and end of the frame."""
-            name = bytearray(self._answer)
-            del name[-1]
-            del name[0]
-            self._ab._programmer_name = name.decode("utf-8")
+            self._ab._programmer_name = self._answer[1:-1].decode("utf-8")
 
             return True
 
@@ -370,14 +770,17 @@ class ArduinoBootloader(object):
             :rtype: bool
             """
             if self._cmd_request(b"u ", answer_len=5):
-                return self._ab._is_cpu_signature((self._answer[1] << 16) | (self._answer[2] << 8) | self._answer[3])
+                if self._ab._is_cpu_signature(bytes(self._answer[1:4])):
+                    self._write_page = self._make_write_page(self._ab._cpu_page_size)
+                    return True
+            self._write_page = None
             return False
 
         def write_memory(self, buffer, address, flash=True):
             """Write the buffer to the requested address of memory.
 
-            :param buffer: data to write.
-            :type buffer: bytearray
+            :param buffer: data to write, the views are not copied except to the command.
+            :type buffer: bytes, bytearray or memoryview
             :param address: memory address of the first byte (16 bits).
             :type address: int
             :param flash: for old bootloader version can be flash or eeprom.
@@ -385,21 +788,70 @@ class ArduinoBootloader(object):
             :return: True the buffer was successfully written.
             :rtype: bool
             """
+            pages = self._split_pages(buffer, flash)
+            if pages:
+                return self.write_memory_pipelined(pages, address, flash)
+
             if self._set_address(address, flash):
                 buff_len = len(buffer)
 
-                cmd = bytearray(4)
-                cmd[0] = ord('d')
-                cmd[1] = ((buff_len >> 8) & 0xFF)
-                cmd[2] = (buff_len & 0xFF)
-                cmd[3] = ord('F') if flash else ord('E')
-
-                cmd.extend(buffer)
-                cmd.append(ord(' '))
+                if flash and self._write_page and buff_len == self._ab._cpu_page_size:
+                    return self._write_page(buffer)
 
-                return self._cmd_request(cmd, answer_len=2)
+                return self._cmd_request(self._page_cmd(buffer, flash), answer_len=2)
             return False
 
+        def write_memory_pipelined(self, pages, address, flash=True, depth=None):
+            """Write consecutive pages starting at the requested address of memory.
+            With a depth of one, each page waits for the answer of the previous one.
+            With more, the set address and write commands of up to depth pages are sent
+            together in a single write, and their answers are read together, so the
+            transmission of the batch is not interrupted by the round trip of each command.
+            If the bootloader does not confirm a batch, its pages are written one by one.
+
+            :param pages: data of each page to write.
+            :type pages: iterable of bytes, bytearray or memoryview
+            :param address: memory address of the first byte of the first page (16 bits).
+            :type address: int
+            :param flash: for old bootloader version can be flash or eeprom.
+            :type flash: bool
+            :param depth: count of pages of each batch, None for the pipeline_depth.
+            :type depth: int
+            :return: True all the pages were successfully written.
+            :rtype: bool
+            """
+            depth = depth or self.pipeline_depth
+            pages = list(pages)
+            batches = [pages[first:first + depth] for first in range(0, len(pages), depth)]
+            cmd = None
+            for index, batch in enumerate(batches):
+                next_address = address + sum(len(buffer) for buffer in batch)
+
+                if len(batch) > 1 and self._ab.device:
+                    if cmd is None:
+                        cmd = self._batch_cmd(batch, address, flash)
+                    self._ab._write(cmd)
+                    sent = len(cmd)
+
+                    """The next batch starts at the same address even if this one fails,
+                    so its command is valid in both cases."""
+                    cmd = None
+                    if index + 1 < len(batches):
+                        cmd = self._batch_cmd(batches[index + 1], next_address, flash)
+
+                    """Each page has two answers, one for the address and one for the data."""
+                    if self._batch_answers(answer_count=len(batch) * 2, sent=sent):
+                        address = next_address
+                        continue
+
+                    self._discard_answers()
+
+                for buffer in batch:
+                    if not self.write_memory(buffer, address, flash):
+                        return False
+                    address += len(buffer)
+            return True
+
         def read_memory(self, address, count, flash=True):
             """Read the memory from requested address.
 
@@ -409,24 +861,92 @@ class ArduinoBootloader(object):
             :type count: int
             :param flash: eeprom supported only by the older version of bootloader.
             :type flash: bool
-            :return: the buffer read or None when there is error.
-            :rtype: bytearray
+            :return: the buffer read or None when there is error, as a view of the response
+                     (the response is immutable, so the view stays valid after the next command).
+            :rtype: memoryview
             """
+            page_size = self._ab._cpu_page_size
+            if flash and page_size and count > page_size:
+                return self._read_pages(address, count, flash)
+
             if self._set_address(address, flash):
-                cmd = bytearray(5)
-                cmd[0] = ord('t')
-                cmd[1] = ((count >> 8) & 0xFF)
-                cmd[2] = (count & 0xFF)
-                cmd[3] = ord('F') if flash else ord('E')
-                cmd[4] = ord(' ')
-
-                if self._cmd_request(cmd, answer_len=count+2):
-                    # The answer start with RESP_STK_IN_SYNC and finish with RESP_STK_OK
-                    buffer = bytearray(self._answer[1:count+1])
-
-                    return buffer
+                if self._cmd_request(self._read_cmd(count, flash), answer_len=count+2):
+                    # The answer start with RESP_STK_IN_SYNC and finish with RESP_STK_OK,
+                    # they are discarded without copying the data.
+                    return memoryview(self._answer)[1:count+1]
             return None
 
+        def _read_batch(self, address, sizes, flash):
+            """Send the set address and read commands of several pages in a single write,
+            and read their answers together.
+
+            :param address: memory address of the first byte to read. (16 bits).
+            :type address: int
+            :param sizes: bytes to read of each page.
+            :type sizes: list
+            :type flash: bool
+            :return: the data of the pages or None when there is error.
+            :rtype: bytes
+            """
+            parts = []
+            offset = address
+            for size in sizes:
+                parts.append(self._address_cmd(offset, flash))
+                parts.append(self._read_cmd(size, flash))
+                offset += size
+            cmd = b"".join(parts)
+            self._ab._write(cmd)
+
+            """Each page has the answer of the address, followed by the data between
+            the start and the end of frame."""
+            count = sum(sizes)
+            answer = self._ab._read_exact(count + len(sizes) * 4, sent=len(cmd))
+            if len(answer) != count + len(sizes) * 4:
+                return None
+
+            head = bytes((RESP_STK_IN_SYNC, RESP_STK_OK, RESP_STK_IN_SYNC))
+            view = memoryview(answer)
+            data = []
+            pos = 0
+            for size in sizes:
+                if not answer.startswith(head, pos) or answer[pos + 3 + size] != RESP_STK_OK:
+                    return None
+                data.append(view[pos + 3:pos + 3 + size])
+                pos += size + 4
+            return b"".join(data)
+
+        def _read_cmd(self, count, flash):
+            """Build the command to read from the current address.
+
+            :param count: bytes to read.
+            :type count: int
+            :type flash: bool
+            :return: the command.
+            :rtype: bytes
+            """
+            return _PAGE_HDR.pack(STK_READ_PAGE, count,
+                                  STK_MEMTYPE_FLASH if flash else STK_MEMTYPE_EEPROM) + b' '
+
+        def _make_write_page(self, page_size):
+            """Build the function that writes a full page of flash in the current address.
+            The command is preallocated once with the fixed fields of the page size,
+            so each call only copies the data.
+
+            :param page_size: cpu flash page size in bytes.
+            :type page_size: int
+            :return: function that receives the page data and returns True when success.
+            :rtype: function
+            """
+            cmd = bytearray(_PAGE_HDR.size + page_size + 1)
+            _PAGE_HDR.pack_into(cmd, 0, STK_PROG_PAGE, page_size, STK_MEMTYPE_FLASH)
+            cmd[-1] = CRC_EOP
+
+            def write_page(buffer):
+                cmd[4:-1] = buffer
+                return self._cmd_request(cmd, answer_len=2)
+
+            return write_page
+
         def _set_address(self, address, flash):
             """The address flash are in words, and the eeprom in bytes.
 
@@ -436,17 +956,51 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
+            return self._cmd_request(self._address_cmd(address, flash), answer_len=2)
+
+        def _address_cmd(self, address, flash):
+            """Build the command to set the address.
+
+            :param address: address in memory of the first byte (16 bits).
+            :type address: int
+            :type flash: bool
+            :return: the command.
+            :rtype: bytes
+            """
             if flash:
                 address = int(address / 2)
 
             """The address is in little endian format"""
-            cmd = bytearray(4)
-            cmd[0] = ord('U')
-            cmd[1] = (address & 0xFF)
-            cmd[2] = ((address >> 8) & 0xFF)
-            cmd[3] = ord(' ')
+            return _SET_ADDR.pack(STK_LOAD_ADDRESS, address & 0xFFFF, CRC_EOP)
+
+        def _page_cmd(self, buffer, flash):
+            """Build the command to write the buffer in the current address.
+
+            :param buffer: data to write.
+            :type buffer: bytearray
+            :type flash: bool
+            :return: the command.
+            :rtype: bytes
+            """
+            header = _PAGE_HDR.pack(STK_PROG_PAGE, len(buffer),
+                                    STK_MEMTYPE_FLASH if flash else STK_MEMTYPE_EEPROM)
+            return header + buffer + b' '
+
+        def chip_erase(self):
+            """Erase the whole flash with the chip erase instruction, so the page writes
+            don't need to erase each page. Optiboot and ATmegaBOOT acknowledge the universal
+            command but don't execute it, they keep erasing each page while it is written.
 
-            return self._cmd_request(cmd, answer_len=2)
+            :return: True when success.
+            :rtype: bool
+            """
+            cmd = bytes((STK_UNIVERSAL,)) + AVR_OP_CHIP_ERASE + bytes((CRC_EOP,))
+            if self._cmd_request(cmd, answer_len=3):
+                return True
+
+            """Discards the answer of the bootloaders that don't support the command."""
+            self._ab.device.reset_input_buffer()
+            return False
 
         def leave_bootloader(self):
             """Leave programming mode and start executing the stored firmware
@@ -466,9 +1020,10 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            if self._ab.device:
-                self._ab.device.write(msg)
-                self._answer = self._ab.device.read(answer_len)
+            dev = self._ab.device
+            if dev:
+                self._ab._write(msg)
+                self._answer = self._ab._read_exact(answer_len, sent=len(msg))
 
                 """If the answer has at least two characters, check that the first and last 
                 corresponds to the start and end sentinel."""
@@ -477,6 +1032,37 @@ class ArduinoBootloader(object):
                     return True
             return False
 
+        def _batch_cmd(self, batch, address, flash):
+            """Build the set address and write commands of consecutive pages.
+
+            :param batch: data of each page to write.
+            :type batch: list of bytearray
+            :param address: memory address of the first byte of the first page (16 bits).
+            :type address: int
+            :type flash: bool
+            :return: the commands.
+            :rtype: bytes
+            """
+            parts = []
+            for buffer in batch:
+                parts.append(self._address_cmd(address, flash))
+                parts.append(self._page_cmd(buffer, flash))
+                address += len(buffer)
+            return b"".join(parts)
+
+        def _batch_answers(self, answer_count, sent):
+            """Receive the answers of several commands sent at once, which have no data.
+
+            :param answer_count: count of commands.
+            :type answer_count: int
+            :param sent: bytes of the commands.
+            :type sent: int
+            :return: True when all the commands were successful.
+            :rtype: bool
+            """
+            self._answer = self._ab._read_exact(answer_count * 2, sent=sent)
+            return self._answer == bytes((RESP_STK_IN_SYNC, RESP_STK_OK)) * answer_count
+
         def _cmd_request(self, msg, answer_len):
             """Send and receive a command in stk500v1 format
             verifies that the response size matches what is expected.
@@ -493,13 +1079,23 @@ class ArduinoBootloader(object):
 
             return False
 
-    class Stk500v2(object):
+    class Stk500v2(_Programmer):
         """It encapsulates the communication protocol that Arduino uses in bootloaders
         with more than 128K bytes of flash memory. For example: Mega 2560 etc"""
         def __init__(self, ab):
             self._ab = ab
             self._answer = None
             self._sequence_number = 0
+            self._write_page = None
+            """Count of commands sent without waiting for the answer of the previous ones.
+            The wiring bootloader polls the UART and loses the frames received while it
+            writes the flash or sends a page, so by default each command waits for its
+            answer. Only a bootloader that buffers the UART can use more than one."""
+            self.pipeline_depth = 1
+            """Messages preallocated for the commands that are sent more often."""
+            self._addr_msg = bytearray(4)
+            self._sig_msg = bytearray(6)
+            self._sig_msg[3] = ord('0') # Get signature
 
         def open(self, port=None, speed=115200):
             """Find and open the communication port where the Arduino is connected.
@@ -523,40 +1119,57 @@ class ArduinoBootloader(object):
             self._ab.close()
 
         def get_sync(self):
-            """Send the sync command
+            """Send the sync command.
+            Poll the bootloader while it starts after the reset, sending the sign on command every 20mS
+            for up to 1 second. The late answers of the previous tries are discarded by their sequence number.
 
             :return: True when success.
             :rtype: bool
             """
-            if self._send_command(CMD_SIGN_ON):
-                if self._recv_answer(CMD_SIGN_ON):
+            deadline = time.monotonic() + 1
+            self._ab.device.timeout = 1 / 50
+            while time.monotonic() < deadline:
+                if self._send_command(CMD_SIGN_ON) and self._recv_answer(CMD_SIGN_ON):
+                    self._ab.device.timeout = SERIAL_TIMEOUT
                     prog_name_len = self._answer[0]
-                    del self._answer[0]
+                    self._answer = self._answer[1:]
 
-                    self._ab._programmer_name = self._answer.decode("utf-8")
+                    self._ab._programmer_name = bytes(self._answer).decode("utf-8")
                     return True
+
+            self._ab.device.timeout = SERIAL_TIMEOUT
             return False
 
         def board_request(self):
             """Get the firmware and hardware version of the bootloader.
+            The parameters are requested one by one. With a pipeline_depth of more than one,
+            the three are requested in a single write, and the answers are matched by their
+            sequence number; if there is an error, they are requested one by one.
 
             :return: True when success.
             :rtype: bool
             """
-            if not self._get_params(OPT_HW_VERSION):
-                return False
+            options = (OPT_HW_VERSION, OPT_SW_MAJOR, OPT_SW_MINOR)
 
-            self._ab._hw_version = self._answer[0]
+            answers = None
+            if self.pipeline_depth > 1:
+                sequences = self._send_many([(CMD_GET_PARAMETER, option) for option in options])
+                if sequences:
+                    answers = self._recv_many(CMD_GET_PARAMETER, sequences)
 
-            if not self._get_params(OPT_SW_MAJOR):
-                return False
-
-            self._ab._hw_version = self._answer[0]
+                if answers is None:
+                    self._discard_answers()
 
-            if not self._get_params(OPT_SW_MINOR):
-                return False
+            if answers is None:
+                answers = []
+                for option in options:
+                    if not self._get_params(option):
+                        return False
+                    answers.append(self._answer)
 
-            self._ab._sw_minor = self._answer[0]
+            self._ab._hw_version = answers[0][0]
+            self._ab._sw_major = answers[1][0]
+            self._ab._sw_minor = answers[2][0]
 
             return True
 
@@ -566,26 +1179,23 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            signature = 0
-            if not self._get_signature(CPU_SIG1):
-                return False
-            signature = (self._answer[3] << 16)
-
-            if not self._get_signature(CPU_SIG2):
-                return False
-            signature |= (self._answer[3] << 8)
-
-            if not self._get_signature(CPU_SIG3):
-                return False
-            signature |= self._answer[3]
-
-            return self._ab._is_cpu_signature(signature)
+            signature = bytearray(3)
+            for index in (CPU_SIG1, CPU_SIG2, CPU_SIG3):
+                if not self._get_signature(index):
+                    return False
+                signature[index] = self._answer[3]
+
+            if self._ab._is_cpu_signature(bytes(signature)):
+                self._write_page = self._make_write_page(self._ab._cpu_page_size)
+                return True
+            self._write_page = None
+            return False
 
         def write_memory(self, buffer, address, flash=True):
             """Write the buffer to the requested address of memory.
 
-            :param buffer: data to write.
-            :type buffer: bytearray
+            :param buffer: data to write, the views are not copied except to the command.
+            :type buffer: bytes, bytearray or memoryview
             :param address: memory address of the first byte (32 bits).
             :type address: int
             :param flash: stk500v2 version only supports flash.
@@ -593,18 +1203,68 @@ class ArduinoBootloader(object):
             :return: True the buffer was successfully written.
             :rtype: bool
             """
-            if self._load_address(address, flash):
-                buff_len = len(buffer)
+            pages = self._split_pages(buffer, flash)
+            if pages:
+                return self.write_memory_pipelined(pages, address, flash)
 
-                msg = bytearray(9)
-                msg[0] = ((buff_len >> 8) & 0xFF)
-                msg[1] = (buff_len & 0xFF)
-                msg.extend(buffer)
-                """The seven bytes preceding the data are not used."""
-                if self._send_command(CMD_PROGRAM_FLASH_ISP, msg):
+            if self._load_address(address, flash):
+                if self._send_program_flash(buffer):
                     return self._recv_answer(CMD_PROGRAM_FLASH_ISP)
             return False
 
+        def write_memory_pipelined(self, pages, address, flash=True, depth=None):
+            """Write consecutive pages starting at the requested address of memory.
+            With a depth of one, each page waits for the answer of the previous one. With more,
+            up to depth commands are sent without waiting for their answer, so the transmission
+            of a page overlaps with the wait for the answer of the previous ones.
+            The bootloader increments the address after each page, so it is loaded only once.
+            If there is an error, the pages still not confirmed are written one by one.
+
+            :param pages: data of each page to write.
+            :type pages: iterable of bytes, bytearray or memoryview
+            :param address: memory address of the first byte of the first page (32 bits).
+            :type address: int
+            :param flash: stk500v2 version only supports flash.
+            :type flash: bool
+            :param depth: maximum count of commands waiting for the answer, None for the
+                          pipeline_depth.
+            :type depth: int
+            :return: True all the pages were successfully written.
+            :rtype: bool
+            """
+            depth = depth or self.pipeline_depth
+            pages = list(pages)
+            pending = collections.deque()
+            confirmed = 0
+
+            if self._load_address(address, flash):
+                for buffer in pages:
+                    if len(pending) >= depth:
+                        if not self._recv_answer(CMD_PROGRAM_FLASH_ISP, pending.popleft()):
+                            break
+                        confirmed += 1
+
+                    if not self._send_program_flash(buffer):
+                        break
+                    pending.append(self._sequence_number)
+
+                """Drain the answers of the last pages sent."""
+                while pending and confirmed + len(pending) == len(pages):
+                    if not self._recv_answer(CMD_PROGRAM_FLASH_ISP, pending.popleft()):
+                        break
+                    confirmed += 1
+
+                if confirmed == len(pages):
+                    return True
+
+            self._discard_answers()
+            address += sum(len(buffer) for buffer in pages[:confirmed])
+            for buffer in pages[confirmed:]:
+                if not self.write_memory(buffer, address, flash):
+                    return False
+                address += len(buffer)
+            return True
+
         def read_memory(self, address, count, flash=True):
             """Read the memory from requested address.
 
@@ -614,29 +1274,75 @@ class ArduinoBootloader(object):
             :type count: int
             :param flash: stk500v2 version only supports flash.
             :type flash: bool
-            :return: the buffer read or None when there is error.
-            :rtype: bytearray
+            :return: the buffer read or None when there is error, as a view of the response.
+            :rtype: memoryview
             """
+            page_size = self._ab._cpu_page_size
+            if flash and page_size and count > page_size:
+                return self._read_pages(address, count, flash)
+
             if self._load_address(address, flash):
-                msg = bytearray(3)
-                msg[0] = ((count >> 8) & 0xFF)
-                msg[1] = (count & 0xFF)
-                """The third byte is not used"""
+                """The length is in big endian format, and the third byte is not used"""
+                msg = count.to_bytes(2, "big") + b'\x00'
                 if self._send_command(CMD_READ_FLASH_ISP, msg):
                     if self._recv_answer(CMD_READ_FLASH_ISP):
                         """The end of data is marked with STATUS_OK"""
                         if self._answer[-1] == STATUS_CMD_OK:
-                            del self._answer[-1]
-                            return self._answer
+                            return self._answer[:-1]
             return None
 
+        def _read_batch(self, address, sizes, flash):
+            """Send the read commands of several pages in a single write, and read their
+            answers. The bootloader increments the address after each read, so it is loaded once.
+
+            :param address: memory address of the first byte to read. (32 bits).
+            :type address: int
+            :param sizes: bytes to read of each page.
+            :type sizes: list
+            :type flash: bool
+            :return: the data of the pages or None when there is error.
+            :rtype: bytes
+            """
+            if not self._load_address(address, flash):
+                return None
+
+            sequences = self._send_many([(CMD_READ_FLASH_ISP, size.to_bytes(2, "big") + b'\x00')
+                                         for size in sizes])
+            if not sequences:
+                return None
+
+            answers = self._recv_many(CMD_READ_FLASH_ISP, sequences)
+
+            """The data of each answer is followed by STATUS_OK"""
+            if answers is not None and all(len(answer) == size + 1 and answer[-1] == STATUS_CMD_OK
+                                           for answer, size in zip(answers, sizes)):
+                return b"".join(answer[:-1] for answer in answers)
+            return None
+
+        def chip_erase(self):
+            """Erase the whole flash with the chip erase instruction, so the page writes
+            don't need to erase each page. The Arduino wiring bootloader doesn't execute it,
+            and on purpose it answers STATUS_CMD_FAILED (Arduino issue 543), so on a Mega the
+            result is False even when the communication is fine. It keeps erasing each page
+            while it is written, so the flash can be written anyway.
+
+            :return: True when the bootloader answered STATUS_CMD_OK.
+            :rtype: bool
+            """
+            """The erase delay in mS, the poll method (0 uses the delay) and the instruction."""
+            msg = bytes((10, 0)) + AVR_OP_CHIP_ERASE
+            if self._send_command(CMD_CHIP_ERASE_ISP, msg):
+                return self._recv_answer(CMD_CHIP_ERASE_ISP)
+
+            return False
+
         def leave_bootloader(self):
             """Leave programming mode and start executing the stored firmware
 
             :return: True when success.
             :rtype: bool
             """
-            msg = bytearray(3)
+            msg = bytes(3)
             if self._send_command(CMD_LEAVE_PROGMODE_ISP, msg):
                 return self._recv_answer(CMD_LEAVE_PROGMODE_ISP)
 
@@ -655,13 +1361,10 @@ class ArduinoBootloader(object):
             if flash:
                 address = int(address / 2)
 
-            msg = bytearray(4)
-            msg[0] = (((address >> 24) & 0xFF) | 0x80)
-            msg[1] = ((address >> 16) & 0xFF)
-            msg[2] = ((address >> 8) & 0xFF)
-            msg[3] = (address & 0xFF)
+            """The address is in big endian format, and the most significant bit is always set."""
+            struct.pack_into('>I', self._addr_msg, 0, (address & 0x7FFFFFFF) | 0x80000000)
 
-            if self._send_command(CMD_LOAD_ADDRESS, msg):
+            if self._send_command(CMD_LOAD_ADDRESS, self._addr_msg):
                 return self._recv_answer(CMD_LOAD_ADDRESS)
             return False
 
@@ -673,11 +1376,9 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            msg = bytearray(6)
-            msg[3] = ord('0') # Get signature
-            msg[5] = index
+            self._sig_msg[5] = index
 
-            if self._send_command(CMD_SPI_MULTI, msg):
+            if self._send_command(CMD_SPI_MULTI, self._sig_msg):
                 return self._recv_answer(CMD_SPI_MULTI)
             return False
 
@@ -693,6 +1394,52 @@ class ArduinoBootloader(object):
                 return self._recv_answer(CMD_GET_PARAMETER)
             return False
 
+        def _send_program_flash(self, buffer):
+            """Send the command to write the buffer in the current address of the flash.
+
+            :param buffer: data to write.
+            :type buffer: bytearray
+            :return: True when success.
+            :rtype: bool
+            """
+            buff_len = len(buffer)
+
+            if self._write_page and buff_len == self._ab._cpu_page_size and self._ab.device:
+                return self._write_page(buffer)
+
+            """The length is in big endian format, and the seven bytes preceding the data are not used."""
+            msg = b"".join((buff_len.to_bytes(2, "big"), bytes(7), buffer))
+            return self._send_command(CMD_PROGRAM_FLASH_ISP, msg)
+
+        def _make_write_page(self, page_size):
+            """Build the function that sends the command to write a full page of flash.
+            The frame is preallocated once with the header, length and command of the page size,
+            and the checksum of those fixed fields is precalculated, so each call only copies the
+            data and completes the sequence number and the checksum.
+
+            :param page_size: cpu flash page size in bytes.
+            :type page_size: int
+            :return: function that receives the page data and returns True when it was sent.
+            :rtype: function
+            """
+            data_len = 1 + 9 + page_size
+            frame = bytearray(_V2_HDR.size + data_len + 1)
+            _V2_HDR.pack_into(frame, 0, MESSAGE_START, 0, data_len, TOKEN)
+            frame[5] = CMD_PROGRAM_FLASH_ISP
+            frame[6] = ((page_size >> 8) & 0xFF)
+            frame[7] = (page_size & 0xFF)
+            checksum = _xor_checksum(frame)
+
+            def write_page(buffer):
+                self._inc_sequence_numb()
+                frame[1] = self._sequence_number
+                frame[15:-1] = buffer
+                frame[-1] = _xor_checksum(buffer, checksum ^ self._sequence_number)
+                self._ab._write(frame)
+                return True
+
+            return write_page
+
         def _inc_sequence_numb(self):
             """Controls the overflow of the sequence number (8 bits)"""
             self._sequence_number += 1
@@ -709,77 +1456,150 @@ class ArduinoBootloader(object):
             :return: True when success.
             :rtype: bool
             """
-            if self._ab.device:
-                self._inc_sequence_numb()
+            dev = self._ab.device
+            if dev:
+                self._ab._write(self._make_frame(cmd, data))
+                return True
+            return False
 
-                buff = bytearray(5)
-                checksum = 0
-                data_len = 1 if data is None else len(data) + 1
+        def _send_many(self, commands):
+            """Send several commands in a single write, each one with its own sequence number.
 
-                buff[0] = MESSAGE_START
-                buff[1] = self._sequence_number
-                buff[2] = ((data_len >> 8) & 0xFF)
-                buff[3] = (data_len & 0xFF)
-                buff[4] = TOKEN
-                buff.append(cmd)
-                if not data is None:
-                    buff.extend(data)
+            :param commands: command and data (or None) of each one.
+            :type commands: list of tuple
+            :return: the sequence numbers of the commands, or None when there is no device.
+            :rtype: list
+            """
+            dev = self._ab.device
+            if dev:
+                buff = bytearray()
+                sequences = []
+                for cmd, data in commands:
+                    buff += self._make_frame(cmd, data)
+                    sequences.append(self._sequence_number)
+
+                self._ab._write(buff)
+                return sequences
+            return None
 
-                for val in buff:
-                    checksum ^= val
+        def _recv_many(self, cmd, sequences):
+            """Receive in order the answers of the commands sent with _send_many.
 
-                buff.append(checksum)
+            :param cmd: command to which the responses belong.
+            :type cmd: int
+            :param sequences: sequence numbers of the commands.
+            :type sequences: list
+            :return: the data of each answer, or None when there is an error.
+            :rtype: list of memoryview
+            """
+            answers = []
+            for sequence in sequences:
+                if not self._recv_answer(cmd, sequence):
+                    return None
+                answers.append(self._answer)
+            return answers
 
-                self._ab.device.write(buff)
-                return True
-            return False
+        def _make_frame(self, cmd, data=None):
+            """Build the frame of a command with the next sequence number.
 
-        def _recv_answer(self, cmd):
+            :param cmd: supported command.
+            :type index: int
+            :param data: if it is not None, it is added to the data buffer.
+            :type data: bytearray
+            :return: the frame.
+            :rtype: bytearray
+            """
+            self._inc_sequence_numb()
+
+            data_len = 1 if data is None else len(data) + 1
+
+            """The frame is allocated with its final size: header, command, data and checksum."""
+            buff = bytearray(_V2_HDR.size + data_len + 1)
+            _V2_HDR.pack_into(buff, 0, MESSAGE_START, self._sequence_number, data_len, TOKEN)
+            buff[5] = cmd
+            if not data is None:
+                buff[6:-1] = data
+
+            buff[-1] = _xor_checksum(buff)
+            return buff
+
+        def _recv_answer(self, cmd, sequence=None):
             """The response have a fixed size header that inform the data len, and the
             first two bytes of the data contain the command and the operation status.
 
             :param cmd: command to which the response belongs.
             :type index: int
+            :param sequence: sequence number of the command, None for the last one sent.
+            :type sequence: int
             :return: True when success.
             :rtype: bool
             """
-            head = self._read_headear()
+            head = self._read_headear(self._sequence_number if sequence is None else sequence)
             if not head is None:
                 """Add one because the length does not include the checksum byte"""
                 len_data = ((head[1] << 8) | head[2]) + 1
                 """The minimum response contains the command and the status of the operation."""
                 if len_data >= 3:
-                    self._answer = bytearray(self._ab.device.read(len_data))
-                    if len(self._answer) == len_data and\
-                        self._answer[0] == cmd and self._answer[1] == STATUS_CMD_OK:
-                        answ_chk = self._answer[-1]
-                        del self._answer[-1]
-
-                        head.extend(self._answer)
-
+                    answer = memoryview(self._ab._read_exact(len_data))
+                    if len(answer) == len_data and\
+                        answer[0] == cmd and answer[1] == STATUS_CMD_OK:
                         """The head don't include the START_MESSAGE byte"""
-                        checksum = MESSAGE_START
-                        for val in head:
-                            checksum ^= val
-                        """Discards the command and status from the response"""
-                        del self._answer[0]
-                        del self._answer[0]
+                        checksum = _xor_checksum(head, MESSAGE_START)
+                        checksum = _xor_checksum(answer[:-1], checksum)
+                        """Discards the command, the status and the checksum from the response
+                        without copying it."""
+                        self._answer = answer[2:-1]
 
                         """The answer is valid when the checksums match"""
-                        return checksum == answ_chk
+                        return checksum == answer[-1]
             return False
 
-        def _read_headear(self):
-            """Wait for the reception of the beginning of frame byte
+        def _read_headear(self, sequence):
+            """Wait for the reception of the beginning of frame byte.
+            The header is read in blocks of up to 5 bytes and the start byte is searched in memory,
+            reading only the bytes missing to complete the header, so the data is never consumed.
+            The bytes are read only when they are already received, polling the port until the
+            deadline given by its timeout, instead of blocking a full timeout on each short read.
 
+            :param sequence: sequence number of the command to which the response belongs.
+            :type sequence: int
             :return: None when timeout, and the header when success.
             :rtype: bytearray
             """
-            for i in range(1, 10):
-                """The header is valid, when the trailing byte sequence number and token match."""
-                start = self._ab.device.read(1)
-                if len(start) >= 1 and start[0] == MESSAGE_START:
-                    head = bytearray(self._ab.device.read(4))
-                    if len(head) == 4 and head[3] == TOKEN and self._sequence_number == head[0]:
-                        return head
-            return None
\ No newline at end of file
+            dev = self._ab.device
+            read = dev.read
+            deadline = time.monotonic() + dev.timeout
+            buff = bytearray()
+            while True:
+                idx = buff.find(MESSAGE_START)
+                if idx < 0:
+                    missing = 5
+                    buff.clear()
+                else:
+                    missing = 5 - (len(buff) - idx)
+                    if missing <= 0:
+                        """The header is valid, when the trailing byte sequence number and token match."""
+                        head = buff[idx + 1:idx + 5]
+                        if head[3] == TOKEN and sequence == head[0]:
+                            return head
+                        """False start, look for the next one in the buffer."""
+                        del buff[:idx + 1]
+                        continue
+
+                waiting = dev.in_waiting
+                if waiting:
+                    buff.extend(read(min(waiting, missing)))
+                elif time.monotonic() < deadline:
+                    time.sleep(1 / 2000)
+                else:
+                    return None
+
+    _PROTOCOLS = {"Stk500v1": Stk500v1, "Stk500v2": Stk500v2}
+    """Programmer class that implements each supported protocol."""
+
+
+Stk500v1 = ArduinoBootloader.Stk500v1
+"""Programmer of the Stk500v1 protocol, the instances are obtained with ArduinoBootloader.select_programmer"""
+
+Stk500v2 = ArduinoBootloader.Stk500v2
+"""Programmer of the Stk500v2 protocol, the instances are obtained with ArduinoBootloader.select_programmer"""
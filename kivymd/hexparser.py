@@ -0,0 +1,108 @@
+'''
+Parser of the Intel HEX files of the APP. It is in a module without the Kivy imports,
+because the process of the parser imports the module of its target to run it.
+'''
+import binascii
+
+from intelhex import IntelHex
+from intelhex import AddressOverlapError
+from intelhex import IntelHexError
+
+
+def parse_hex_image(path):
+    """Fast path of the parser for the usual files of the compilers. Each record is decoded
+       with binascii, that converts the hex digits in C, and its data is copied to a flat
+       image with a slice assignment, instead of a dictionary entry per byte as IntelHex.
+       The records must be in ascending order of address, any other file raises ValueError
+       and it is left to IntelHex, that also reports the errors.
+
+    :param path: file and path of the firmware.
+    :type path: str
+    :return: the first and last address, the image from the address 0 and the segments.
+    :rtype: tuple
+    """
+    image = bytearray()
+    segments = []
+    base = 0
+    with open(path, "rb") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line[:1] != b":":
+                raise ValueError("record without start code")
+
+            record = binascii.unhexlify(line[1:])
+            count = record[0]
+            if len(record) != count + 5 or sum(record) & 0xFF:
+                raise ValueError("record with invalid length or checksum")
+
+            kind = record[3]
+            if kind == 0 and count:
+                address = base + ((record[1] << 8) | record[2])
+                end = address + count
+                if segments and address == segments[-1][1]:
+                    segments[-1] = (segments[-1][0], end)
+                elif not segments or address > segments[-1][1]:
+                    segments.append((address, end))
+                else:
+                    raise ValueError("record out of order")
+
+                if len(image) < address:
+                    image += b'\xff' * (address - len(image))
+                image[address:end] = record[4:4 + count]
+            elif kind == 1:
+                break
+            elif kind == 2:
+                base = ((record[4] << 8) | record[5]) << 4
+            elif kind == 4:
+                base = ((record[4] << 8) | record[5]) << 16
+            elif kind not in (0, 3, 5):
+                raise ValueError("unknown record type")
+
+    if not segments:
+        raise ValueError("file without data")
+
+    return segments[0][0], segments[-1][1] - 1, bytes(image), segments
+
+
+def parse_worker(path, queue):
+    """Parse the Intel HEX file in a process of its own, so the pure python parser uses
+       another core instead of competing with the UI for the GIL. The contiguous image of
+       the firmware and its segments are sent back through the queue, or the error message.
+
+    :param path: file and path of the firmware.
+    :type path: str
+    :param queue: queue where the result is put.
+    :type queue: multiprocessing.Queue
+    """
+    try:
+        queue.put(["ok"] + list(parse_hex_image(path)))
+        return
+    except Exception:
+        """The files that the fast path doesn't accept are parsed by IntelHex."""
+        pass
+
+    try:
+        ih = IntelHex()
+        ih.fromfile(path, format='hex')
+    except FileNotFoundError:
+        queue.put(["error", "File not found"])
+        return
+    except AddressOverlapError:
+        queue.put(["error", "File with address overlapped"])
+        return
+    except (IntelHexError, OSError):
+        queue.put(["error", "File with invalid format"])
+        return
+    except Exception:
+        """Any other error, for example the bytes that are not text, must also be reported,
+        because the worker thread waits for a result."""
+        queue.put(["error", "File with invalid format"])
+        return
+
+    if ih.minaddr() is None:
+        queue.put(["error", "File without data"])
+        return
+
+    queue.put(["ok", ih.minaddr(), ih.maxaddr(), ih.tobinstr(start=0, end=ih.maxaddr()), ih.segments()])
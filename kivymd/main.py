@@ -5,12 +5,18 @@ from kivy.lang import Builder
 from kivy.clock import Clock
 from kivymd.app import MDApp
 
+import collections
+import multiprocessing
+import os
 import threading
+from queue import Empty
 from queue import Queue
 
-from intelhex import IntelHex
-from intelhex import AddressOverlapError
 from arduinobootloader import ArduinoBootloader
+from hexparser import parse_worker
+
+PARSE_POLL = 0.5
+"""Seconds between the checks that the parser is alive, while its result is awaited."""
 
 
 KV = '''
@@ -131,20 +137,42 @@ Screen:
                 id: status
                 text:"--"
                        
-        MDRectangleFlatButton:
-            text:"Flash"
+        MDBoxLayout:
+            adaptive_size: True
+            spacing: 10
             pos_hint:{'center_x': .5, 'center_y': .5}
-            on_release:app.on_flash()
+            MDRectangleFlatButton:
+                text:"Flash"
+                on_release:app.on_flash()
+            MDRectangleFlatButton:
+                text:"Abort"
+                on_release:app.on_abort()
 '''
 
 
 class MainApp(MDApp):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.ih = IntelHex()
         self.ab = ArduinoBootloader()
         self.working_thread = None
-        self.progress_queue = Queue(100)
+        """The worker checks the abort event between the transfers."""
+        self.abort_event = threading.Event()
+        self.parse_queue = None
+        self.parser = None
+        """The last parse result, with the path, modification time and size of its file."""
+        self.parse_key = None
+        self.hex_cache = None
+        """The worker thread overwrites the last progress in a single slot, and appends
+           the other messages, that must not be coalesced, in a deque, instead of a queue
+           with a message per page that could block the worker. The lock of the slot is
+           only held for the assignment and the read."""
+        self.progress_lock = threading.Lock()
+        self.progress = None
+        self.shown_progress = None
+        self.events = collections.deque(maxlen=16)
+        """The worker fires a trigger created once, that coalesces the calls until the
+           next frame of 30 Hz, instead of scheduling a clock event per message."""
+        self.progress_trigger = Clock.create_trigger(self.progress_callback, 1 / 30)
         self.protocol = "Stk500v1"
         self.baudrate = 115200
 
@@ -156,30 +184,62 @@ class MainApp(MDApp):
         self.protocol = protocol
 
     def on_flash(self):
-        del self.ih
-
-        try:
-            self.ih = IntelHex()
-            self.ih.fromfile(self.root.ids.file_name.text, format='hex')
-        except FileNotFoundError:
-            self.root.ids.file_info.text = "File not found"
-            return
-        except AddressOverlapError:
-            self.root.ids.file_info.text = "File with address overlapped"
+        """The firmware file is parsed by a worker process, while the worker thread opens
+           the bootloader. On Android the multiprocessing queues are not supported (there
+           is no sem_open), so the file is parsed by a thread. A new update is not started
+           while the worker thread of the previous one is alive."""
+        if self.working_thread and self.working_thread.is_alive():
             return
 
-        self.root.ids.file_info.text = "start address: {} size: {} bytes".format(self.ih.minaddr(), self.ih.maxaddr())
+        path = self.root.ids.file_name.text
+
+        """When the file didn't change since the last update, the cached image is used
+           instead of parsing the file again."""
+        try:
+            stat = os.stat(path)
+            self.parse_key = (path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            self.parse_key = None
+
+        if self.parse_key and self.hex_cache and self.hex_cache[0] == self.parse_key:
+            self.parser = None
+            self.parse_queue = Queue(1)
+            self.parse_queue.put(self.hex_cache[1])
+        else:
+            try:
+                self.parse_queue = multiprocessing.Queue(1)
+                self.parser = multiprocessing.Process(target=parse_worker, args=(path, self.parse_queue),
+                                                      daemon=True)
+            except (ImportError, OSError):
+                self.parse_queue = Queue(1)
+                self.parser = threading.Thread(target=parse_worker, args=(path, self.parse_queue), daemon=True)
+            self.parser.start()
 
         """The firmware update is done in a worker thread because the main 
-           thread in Kivy is in charge of updating the widgets."""
+           thread in Kivy is in charge of updating the widgets. The serial ports 
+           (pyserial and serial4a on Android) are blocking, and release the GIL 
+           while they wait, so the wait does not delay the UI."""
         self.root.ids.progress.value = 0
-        self.working_thread = threading.Thread(target=self.thread_flash)
+        self.progress = None
+        self.shown_progress = None
+        self.events.clear()
+        self.abort_event.clear()
+        self.working_thread = threading.Thread(target=self.thread_flash, daemon=True)
         self.working_thread.start()
 
+    def on_abort(self):
+        """Stop the update after the transfer in progress, the bootloader is left and the
+           port closed by the worker thread."""
+        self.abort_event.set()
+
+    def on_stop(self):
+        """The worker thread is a daemon, so it doesn't keep the process alive when the
+           port hangs, but it is asked to stop before the app exits."""
+        self.abort_event.set()
+
     def thread_flash(self):
         """If the communication with the bootloader through the serial port could be
            established, obtains the information of the processor and the bootloader."""
-        res_val = False
 
         """First you have to select the communication protocol used by the bootloader of 
         the Arduino board. The Stk500V1 is the one used by the Nano or Uno, and depending 
@@ -191,55 +251,130 @@ class MainApp(MDApp):
 
         if prg.open(speed=self.baudrate):
             if prg.board_request():
-                self.progress_queue.put(["board_request"])
-                Clock.schedule_once(self.progress_callback, 1 / 1000)
-
-            if prg.cpu_signature():
-                self.progress_queue.put(["cpu_signature"])
-                Clock.schedule_once(self.progress_callback, 1 / 1000)
-
-            """Iterate the firmware file into chunks of the page size in bytes, and 
-               use the write flash command to update the cpu."""
-            for address in range(0, self.ih.maxaddr(), self.ab.cpu_page_size):
-                buffer = self.ih.tobinarray(start=address, size=self.ab.cpu_page_size)
-                res_val = prg.write_memory(buffer, address)
-                if not res_val:
+                self.put_event(["board_request"])
+
+            cpu_signature = prg.cpu_signature()
+            if cpu_signature:
+                self.put_event(["cpu_signature"])
+
+            """Wait for the image of the firmware, the file was parsed while the bootloader 
+               was reset and queried."""
+            parse_result = self.get_parse_result()
+            if parse_result[0] != "ok":
+                if parse_result[0] == "abort":
+                    self.put_event(["result", "abort"])
+                else:
+                    self.put_event(["file_error", parse_result[1]])
+                prg.leave_bootloader()
+                prg.close()
+                return
+
+            _, min_addr, max_addr, data, segments = parse_result
+            self.put_event(["file_info", min_addr, max_addr])
+
+            """Erase the flash once before writing it, only when the image is valid and has 
+               pages to write, so an invalid file or an abort doesn't leave the board erased. 
+               The result is not checked, because the Arduino bootloaders don't execute it 
+               (wiring even answers STATUS_CMD_FAILED), and they erase each page while it 
+               is written."""
+            if cpu_signature and segments and not self.abort_event.is_set():
+                prg.chip_erase()
+
+            """The verify is interleaved with the write, in a single pass over the image. 
+               The progress is only stored and notified when its integer percent changes."""
+            result = "error"
+            last_percent = -1
+            for phase, fraction in self.ab.flash_binary(data, segments):
+                if self.abort_event.is_set():
+                    result = "abort"
                     break
-
-                self.progress_queue.put(["write", address / self.ih.maxaddr()])
-                Clock.schedule_once(self.progress_callback, 1 / 1000)
-
-            """If the write was successful, re-iterate the firmware file, and use the 
-               read flash command to update and compare them."""
-            if res_val:
-                for address in range(0, self.ih.maxaddr(), self.ab.cpu_page_size):
-                    buffer = self.ih.tobinarray(start=address, size=self.ab.cpu_page_size)
-                    read_buffer = prg.read_memory(address, self.ab.cpu_page_size)
-                    if not len(read_buffer) or (buffer != read_buffer):
-                        res_val = False
-                        break
-
-                    self.progress_queue.put(["read", address / self.ih.maxaddr()])
-                    Clock.schedule_once(self.progress_callback, 1 / 1000)
-
-            self.progress_queue.put(["result", "ok" if res_val else "error", address])
-            Clock.schedule_once(self.progress_callback, 1 / 1000)
+                if phase == "write":
+                    percent = int(fraction * 100)
+                    if percent != last_percent:
+                        last_percent = percent
+                        with self.progress_lock:
+                            self.progress = [phase, percent / 100]
+                        self.progress_trigger()
+                if phase == "done":
+                    result = "ok"
+
+            self.put_event(["result", result])
 
             prg.leave_bootloader()
 
             prg.close()
         else:
-            self.progress_queue.put(["open_error"])
-            Clock.schedule_once(self.progress_callback, 1 / 1000)
+            self.put_event(["open_error"])
+
+            """The parser can't finish until its result is read from the queue."""
+            self.get_parse_result()
+
+    def get_parse_result(self):
+        """Wait for the result of the parser, and keep it in the cache when the file is valid.
+           The wait ends with an error when the parser stopped without a result, and with
+           abort when the update is aborted.
+
+        :return: the type of result (ok, error or abort), followed by the image or the
+                 error message.
+        :rtype: list
+        """
+        while True:
+            try:
+                parse_result = self.parse_queue.get(timeout=PARSE_POLL)
+                break
+            except Empty:
+                if self.abort_event.is_set():
+                    return ["abort"]
+
+                if self.parser is not None and not self.parser.is_alive():
+                    """The result could arrive after the check of the queue."""
+                    try:
+                        parse_result = self.parse_queue.get(timeout=PARSE_POLL)
+                        break
+                    except Empty:
+                        return ["error", "The parser of the file stopped"]
 
-    def progress_callback(self, dt):
-        """In kivy only the main thread can update the widgets. Schedule a clock
-           event to read the message from the queue and update the progress."""
-        value = self.progress_queue.get()
+        if parse_result[0] == "ok" and self.parse_key:
+            self.hex_cache = (self.parse_key, parse_result)
+        return parse_result
+
+    def put_event(self, value):
+        """Called by the worker thread to append a message for the widgets.
+
+        :param value: message, the first item is its type.
+        :type value: list
+        """
+        self.events.append(value)
+        self.progress_trigger()
 
+    def progress_callback(self, dt):
+        """In kivy only the main thread can update the widgets. The trigger
+           shows the last progress, and then the messages of the deque, so the
+           result is always displayed after the progress. The worker stores a new
+           list for each update, so the widgets are updated only when it changes."""
+        with self.progress_lock:
+            progress = self.progress
+        if progress is not self.shown_progress:
+            self.shown_progress = progress
+            self.show_message(progress)
+
+        while self.events:
+            value = self.events.popleft()
+            self.show_message(value)
+
+
+    def show_message(self, value):
+        """Update the widgets with a message of the worker thread."""
         if value[0] == "open_error":
             self.root.ids.status.text = "Can't open bootloader {} at baudrate {}".format(self.protocol, self.baudrate)
 
+        if value[0] == "file_error":
+            self.root.ids.file_info.text = value[1]
+            self.root.ids.status.text = "--"
+
+        if value[0] == "file_info":
+            self.root.ids.file_info.text = "start address: {} size: {} bytes".format(value[1], value[2])
+
         if value[0] == "board_request":
             self.root.ids.sw_version.text = self.ab.sw_version
             self.root.ids.hw_version.text = self.ab.hw_version
@@ -249,11 +384,7 @@ class MainApp(MDApp):
             self.root.ids.cpu_version.text = self.ab.cpu_name
 
         if value[0] == "write":
-            self.root.ids.status.text = "Writing flash %{:.2f}".format(value[1]*100)
-            self.root.ids.progress.value = value[1]
-
-        if value[0] == "read":
-            self.root.ids.status.text = "Reading and verifying flash %{:.2f}".format(value[1]*100)
+            self.root.ids.status.text = "Writing and verifying flash %{:.0f}".format(value[1]*100)
             self.root.ids.progress.value = value[1]
 
         if value[0] == "result" and value[1] == "ok":
@@ -263,5 +394,10 @@ class MainApp(MDApp):
         if value[0] == "result" and value[1] == "error":
             self.root.ids.status.text = "Error writing"
 
+        if value[0] == "result" and value[1] == "abort":
+            self.root.ids.status.text = "Update aborted"
+
 
-MainApp().run()
+"""The guard is needed because the worker process imports this module when it is spawned."""
+if __name__ == '__main__':
+    MainApp().run()
@@ -8,11 +8,14 @@ VERSION = '0.2.0'
 
 import argparse
 import sys
+import time
 
 from intelhex import IntelHex
 from intelhex import AddressOverlapError, HexRecordError
 from arduinobootloader import ArduinoBootloader
-import progressbar
+
+PROGRESS_PERIOD = 0.1
+"""Minimum seconds between the updates of the progress line"""
 
 parser = argparse.ArgumentParser(description="arduino flash utility")
 group = parser.add_mutually_exclusive_group()
@@ -51,6 +54,21 @@ def exit_by_error(msg):
     sys.exit(0)
 
 
+last_progress = 0
+
+
+def show_progress(prefix, fraction, done=False):
+    """Rewrite the progress line in stderr, at most once per period, so the
+       transfers don't wait for the formatting and the write of each update.
+       When done, the line is always written and ended."""
+    global last_progress
+    now = time.monotonic()
+    if done or now - last_progress > PROGRESS_PERIOD:
+        sys.stderr.write("\r{} {:3d}%{}".format(prefix, int(fraction * 100), "\n" if done else ""))
+        sys.stderr.flush()
+        last_progress = now
+
+
 if prg.open(speed=args.baudrate):
     print("AVR device initialized and ready to accept instructions")
     address = 0
@@ -65,6 +83,9 @@ if prg.open(speed=args.baudrate):
 
     print("cpu name: {}".format(ab.cpu_name))
 
+    page_size = ab.cpu_page_size
+    xfer_size = ab.cpu_xfer_size
+
     if args.update:
         print("reading input file: {}".format(args.filename))
 
@@ -75,51 +96,41 @@ if prg.open(speed=args.baudrate):
         except (AddressOverlapError, HexRecordError):
             exit_by_error(msg="error, file format")
 
-        print("writing flash: {} bytes".format(ih.maxaddr()))
-        bar = progressbar.ProgressBar(max_value=ih.maxaddr(), prefix="writing ")
-        bar.start(init=True)
-        for address in range(0, ih.maxaddr(), ab.cpu_page_size):
-            buffer = ih.tobinarray(start=address, size=ab.cpu_page_size)
-            if not prg.write_memory(buffer, address):
-                exit_by_error(msg="writing flash memory")
+        max_address = ih.maxaddr()
 
-            bar.update(address)
+        """The library writes and verifies the firmware in a single pass, the progress
+           is the fraction of the image written."""
+        print("writing and verifying flash: {} bytes".format(max_address))
+        for phase, fraction in ab.flash_image(ih):
+            if phase == "error":
+                exit_by_error(msg="writing and verifying flash memory")
 
-        bar.finish()
+            if phase == "write":
+                show_progress("writing", fraction)
 
-    dict_hex = dict()
+        show_progress("writing", 1, done=True)
 
-    if args.update:
-        max_address = ih.maxaddr()
-        print("reading and verifying flash memory")
-    elif args.read:
-        max_address = int(ab.cpu_page_size * ab.cpu_pages)
+    if args.read:
+        max_address = int(page_size * ab.cpu_pages)
         print("reading flash memory")
-    else:
-        max_address = 0
 
-    bar = progressbar.ProgressBar(max_value=max_address, prefix="reading ")
-    bar.start(init=True)
+        """Each transfer read is copied to its place in a flat image of the flash,
+           and the image is loaded in the IntelHex once at the end."""
+        image = bytearray(max_address)
 
-    for address in range(0, max_address, ab.cpu_page_size):
-        read_buffer = prg.read_memory(address, ab.cpu_page_size)
-        if read_buffer is None:
-            exit_by_error(msg="reading flash memory")
+        for address in range(0, max_address, xfer_size):
+            read_buffer = prg.read_memory(address, min(xfer_size, max_address - address))
+            if read_buffer is None:
+                exit_by_error(msg="reading flash memory")
 
-        if args.update:
-            if read_buffer != ih.tobinarray(start=address, size=ab.cpu_page_size):
-                exit_by_error(msg="file not match")
-        elif args.read:
-            for i in range(0, ab.cpu_page_size):
-                dict_hex[address + i] = read_buffer[i]
+            image[address:address + len(read_buffer)] = read_buffer
 
-        bar.update(address)
+            show_progress("reading", address / max_address)
 
-    bar.finish()
+        show_progress("reading", 1, done=True)
+
+        ih.frombytes(image, offset=0)
 
-    if args.read:
-        dict_hex["start_addr"] = 0
-        ih.fromdict(dict_hex)
         try:
             ih.tofile(args.filename, 'hex')
         except FileNotFoundError: